@@ -2,15 +2,58 @@
 AI report generation with partial credit, naming issues, zip naming.
 """
 
+import io
+import os
+import json
+import time
+import hashlib
+import asyncio
+import functools
+import itertools
 import logging
-import google.generativeai as genai
-from config import GEMINI_API_KEY, get_project, ACTIVE_PROJECT
+from collections.abc import AsyncIterator
+import httpx
+import jinja2
+from aiolimiter import AsyncLimiter
+from google import genai
+from google.genai import errors, types
+from tenacity import (
+    retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter,
+)
+from config import (
+    GEMINI_API_KEYS, GEMINI_CONCURRENCY, GEMINI_RPM, REPORT_CACHE_DIR,
+    get_project, ACTIVE_PROJECT,
+)
 from grading_engine import GradingResult
 
 log = logging.getLogger(__name__)
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = "gemini-2.0-flash"
+KEY_COOLDOWN_SECONDS = 60
+BATCH_POLL_SECONDS = 30
+MAX_DIFF_CHARS = 512
+MAX_PROMPT_CHARS = 20000
+REPORT_CACHE_TTL = 7 * 86400
+REPORT_CACHE_PRUNE_SECONDS = 3600
+_BATCH_DONE = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+# One client per API key, used round-robin. The requests/minute quota is
+# per key, so each key gets its own limiter; a key that returns 429 is
+# skipped for KEY_COOLDOWN_SECONDS.
+_clients = [genai.Client(api_key=k) for k in GEMINI_API_KEYS]
+_limiters = [AsyncLimiter(GEMINI_RPM, 60) for _ in _clients]
+_cooldown_until = [0.0] * len(_clients)
+_rate_limited = [0] * len(_clients)
+_key_cycle = itertools.cycle(range(len(_clients)))
+
+# Caps in-flight calls across all keys.
+_GEMINI_SEM = asyncio.Semaphore(GEMINI_CONCURRENCY)
 
 SYSTEM_PROMPT_TEMPLATE = """\
 You are a friendly TA for "Digital Systems and Computer Architecture" (CH-234) \
@@ -35,6 +78,14 @@ Rules:
 - Sign off: "-- Your CH-234 Teaching Team"
 """
 
+_NL = "\n"
+_PASS_PFX = "  PASS  "
+_PARTIAL_PFX = "  PARTIAL  "
+_FAIL_PFX = "  FAIL  "
+_ITEM_PFX = "  - "
+_EXPECTED_PFX = "\n    Expected: "
+_GOT_PFX = "\n    Got:      "
+
 HINTS = {
     1: {
         "Not": "Not is just Nand(a, a).",
@@ -80,194 +131,491 @@ HINTS = {
     },
 }
 
+_HINT = {(pn, name): h for pn, inner in HINTS.items()
+         for name, h in inner.items()}
 
-async def generate_report(result: GradingResult) -> str:
-    project = get_project(result.project_num)
-    hw = f"Homework {result.project_num}"
-    pname = project["name"]
 
+def _build_prompt(result: GradingResult) -> tuple[str, str]:
     chip_lines = []
     errors = []
+    diffs = []
     for c in result.chips:
         if c.passed:
-            chip_lines.append(f"  PASS  {c.name} ({c.points}/{c.max_points})")
+            chip_lines.append(
+                f"{_PASS_PFX}{c.name} ({c.points}/{c.max_points})")
         elif c.points > 0:
             chip_lines.append(
-                f"  PARTIAL  {c.name} -- {c.passed_tests}/{c.total_tests} "
+                f"{_PARTIAL_PFX}{c.name} -- {c.passed_tests}/{c.total_tests} "
                 f"tests, {c.points}/{c.max_points} pts")
-            d = f"{c.name}: {c.error_msg}"
-            if c.expected and c.actual:
-                d += f"\n    Expected: {c.expected}\n    Got:      {c.actual}"
-            errors.append(d)
+            errors.append(f"{c.name}: {c.error_msg}")
+            diffs.append(_diff(c))
         else:
             chip_lines.append(
-                f"  FAIL  {c.name} -- {c.error_type}: {c.error_msg}")
-            d = f"{c.name} ({c.error_type}): {c.error_msg}"
-            if c.expected and c.actual:
-                d += f"\n    Expected: {c.expected}\n    Got:      {c.actual}"
-            errors.append(d)
+                f"{_FAIL_PFX}{c.name} -- {c.error_type}: {c.error_msg}")
+            errors.append(f"{c.name} ({c.error_type}): {c.error_msg}")
+            diffs.append(_diff(c))
 
     naming = ""
     if result.has_naming_issues:
         nl = ["File naming issues:"]
         if result.zip_naming and not result.zip_naming.is_correct:
-            nl.append(f"  - ZIP: {result.zip_naming.issue}")
+            nl.append(f"{_ITEM_PFX}ZIP: {result.zip_naming.issue}")
         for m in result.naming_issues:
-            nl.append(f"  - {m.issue}")
-        naming = "\n" + "\n".join(nl)
+            nl.append(f"{_ITEM_PFX}{m.issue}")
+        naming = "\n" + _NL.join(nl)
 
-    packaging_w = [w for w in result.warnings if w.startswith("Packaging:")]
+    packaging_w = result.packaging_warnings
     packaging = ""
     if packaging_w:
         packaging = "\nSubmission packaging issues:\n" + \
-            "\n".join(f"  - {w}" for w in packaging_w)
+            _NL.join(f"{_ITEM_PFX}{w}" for w in packaging_w)
 
-    cascade_w = [w for w in result.warnings
-                 if not w.startswith("Naming:")
-                 and not w.startswith("Packaging:")]
+    cascade_w = result.cascade_warnings
     cascade = ""
     if cascade_w:
         cascade = "\nCascade warnings:\n" + \
-            "\n".join(f"  - {w}" for w in cascade_w)
+            _NL.join(f"{_ITEM_PFX}{w}" for w in cascade_w)
+
+    def assemble(errs):
+        return (
+            f"Student: {result.student_name}\n"
+            f"Score: {result.total_earned}/{result.total_possible} "
+            f"({result.percentage}%)\n\n"
+            f"Results:\n{_NL.join(chip_lines)}\n\n"
+            f"Errors:\n{_NL.join(errs) if errs else 'All passed!'}\n"
+            f"{naming}\n{packaging}\n{cascade}")
+
+    prompt = assemble([e + d for e, d in zip(errors, diffs)])
+    if len(prompt) > MAX_PROMPT_CHARS:
+        # Too big to be worth paying for: keep names and error types only.
+        prompt = assemble(errors)
+    return _system_for(result.project_num), prompt
+
+
+def _diff(c):
+    if not (c.expected and c.actual):
+        return ""
+    return f"{_EXPECTED_PFX}{_clip(c.expected)}{_GOT_PFX}{_clip(c.actual)}"
+
 
-    prompt = (
-        f"Student: {result.student_name}\n"
-        f"Score: {result.total_earned}/{result.total_possible} "
-        f"({result.percentage}%)\n\n"
-        f"Results:\n{chr(10).join(chip_lines)}\n\n"
-        f"Errors:\n{chr(10).join(errors) if errors else 'All passed!'}\n"
-        f"{naming}\n{packaging}\n{cascade}")
+def _clip(text, limit=MAX_DIFF_CHARS):
+    return text if len(text) <= limit else text[:limit] + "..."
 
-    system = SYSTEM_PROMPT_TEMPLATE.format(hw_name=hw, project_name=pname)
 
-    if GEMINI_API_KEY:
+# The system prompt is sent as system_instruction, identical for every
+# student of a project, so Gemini can cache it across a grading run.
+@functools.lru_cache(maxsize=32)
+def _gen_config(system: str) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=system, temperature=0.7, max_output_tokens=500)
+
+
+@functools.lru_cache(maxsize=32)
+def _system_for(project_num: int) -> str:
+    return SYSTEM_PROMPT_TEMPLATE.format(
+        hw_name=f"Homework {project_num}",
+        project_name=get_project(project_num)["name"])
+
+
+# All-pass and nothing-passed submissions get the same advice whoever wrote
+# them, so the template is used directly and Gemini is left for the rest.
+def _needs_ai(result):
+    passed = sum(1 for c in result.chips if c.passed)
+    if passed == len(result.chips):
+        return False
+    return not (passed == 0 and result.total_earned == 0)
+
+
+async def generate_report(result: GradingResult) -> str:
+    if not _needs_ai(result):
+        return _template(result)
+    system, prompt = _build_prompt(result)
+
+    if _clients:
+        cache = _cache_path(system, prompt)
+        cached = _cache_get(cache)
+        if cached:
+            return cached
         try:
-            model = genai.GenerativeModel("gemini-2.0-flash")
-            resp = await model.generate_content_async(
-                contents=f"{system}\n\n---\n\n{prompt}",
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.7, max_output_tokens=500))
-            text = resp.text.strip()
+            text = await _ask_gemini(system, prompt)
             if text and len(text) > 30:
+                _cache_put(cache, text)
                 return text
+        except errors.APIError as e:
+            log.warning(f"Gemini failed ({e.code}): {e.message}")
+        except (httpx.TimeoutException, TimeoutError):
+            log.warning("Gemini timed out after retries")
         except Exception as e:
-            log.warning(f"Gemini failed: {e}")
+            log.warning(f"Gemini failed: {e}", exc_info=True)
 
     return _template(result)
 
 
-def _template(result):
-    project = get_project(result.project_num)
-    hints = HINTS.get(result.project_num, {})
-    ext = project["file_ext"]
-    first = result.student_name.split()[0] if result.student_name else "there"
+async def generate_reports(results: list[GradingResult]) -> list[str]:
+    return await asyncio.gather(*(generate_report(r) for r in results))
+
+
+# Regrading unchanged submissions yields the same prompt, so responses are
+# cached on disk by prompt hash; any change in results busts the key.
+def _cache_path(system, prompt):
+    key = hashlib.blake2b(f"{system}\x00{prompt}".encode("utf-8"),
+                          digest_size=16).hexdigest()
+    return REPORT_CACHE_DIR / f"{key}.txt"
+
+
+def _cache_get(path):
+    try:
+        if time.time() - path.stat().st_mtime < REPORT_CACHE_TTL:
+            return path.read_text(encoding="utf-8")
+        path.unlink(missing_ok=True)
+    except OSError:
+        pass
+    return None
 
-    lines = [f"Hi {first},\n"]
-    lines.append(f"Here's your feedback for HW{result.project_num} -- "
-                 f"{project['name']}:\n")
 
-    # Zip naming
+_last_prune = 0.0
+
+
+def _cache_prune():
+    """Delete expired entries; runs at most once per prune interval."""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < REPORT_CACHE_PRUNE_SECONDS:
+        return
+    _last_prune = now
+    try:
+        entries = list(os.scandir(REPORT_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if now - entry.stat().st_mtime >= REPORT_CACHE_TTL:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def _cache_put(path, text):
+    try:
+        REPORT_CACHE_DIR.mkdir(exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f"Could not cache report: {e}")
+    _cache_prune()
+
+
+def _is_transient(exc):
+    # Quota (429), server-side (5xx) and timeouts are worth another try;
+    # anything else (bad key, blocked prompt, ...) will fail the same way.
+    if isinstance(exc, errors.APIError):
+        return exc.code == 429 or exc.code >= 500
+    return isinstance(exc, (httpx.TimeoutException, TimeoutError))
+
+
+def _next_key():
+    now = time.monotonic()
+    for _ in range(len(_clients)):
+        i = next(_key_cycle)
+        if _cooldown_until[i] <= now:
+            return i
+    return min(range(len(_clients)), key=_cooldown_until.__getitem__)
+
+
+async def generate_report_stream(
+        result: GradingResult) -> AsyncIterator[str]:
+    """Yield the report as Gemini produces it (template if unavailable).
+
+    If the stream breaks after text was yielded, the error is re-raised:
+    the partial report must not pass for a complete one.
+    """
+    sent = False
+    if _clients and _needs_ai(result):
+        system, prompt = _build_prompt(result)
+        try:
+            async for piece in _stream_gemini(system, prompt):
+                sent = True
+                yield piece
+        except Exception as e:
+            if sent:
+                log.warning(f"Gemini stream failed mid-report: {e}")
+                raise
+            log.warning(f"Gemini stream failed: {e}")
+    if not sent:
+        yield _template(result)
+
+
+@retry(retry=retry_if_exception(_is_transient),
+       wait=wait_exponential_jitter(initial=2, max=60),
+       stop=stop_after_attempt(5), reraise=True)
+async def _ask_gemini(system, prompt):
+    buf = []
+    async for piece in _stream_gemini(system, prompt):
+        buf.append(piece)
+    return "".join(buf).strip()
+
+
+async def _stream_gemini(system, prompt):
+    i = _next_key()
+    async with _GEMINI_SEM, _limiters[i]:
+        try:
+            stream = await _clients[i].aio.models.generate_content_stream(
+                model=GEMINI_MODEL, contents=[prompt],
+                config=_gen_config(system))
+            async for chunk in stream:
+                if chunk.text:
+                    yield chunk.text
+        except errors.APIError as e:
+            if e.code == 429:
+                _rate_limited[i] += 1
+                _cooldown_until[i] = time.monotonic() + KEY_COOLDOWN_SECONDS
+                log.info(f"Gemini key #{i} rate limited "
+                         f"({_rate_limited[i]} so far), cooling down")
+            raise
+
+
+async def generate_reports_batch(results: list[GradingResult]) -> list[str]:
+    """Generate many reports in one Gemini Batch API job.
+
+    Batch jobs cost half as much but may take hours, so this is for
+    background runs; interactive grading keeps using generate_report().
+    Reports come back in the order of `results`; any student without a
+    usable response gets the template report.
+    """
+    if not results:
+        return []
+    texts = {}
+    if _clients:
+        try:
+            texts = await _run_batch(results)
+        except Exception as e:
+            log.warning(f"Gemini batch failed: {e}")
+    return [texts.get(str(i)) or _template(r)
+            for i, r in enumerate(results)]
+
+
+async def _run_batch(results):
+    # Shares the on-disk cache with generate_report(): cached students are
+    # not uploaded, and fresh batch answers are cached for later runs.
+    texts, paths, lines = {}, {}, []
+    for i, r in enumerate(results):
+        if not _needs_ai(r):
+            continue
+        system, prompt = _build_prompt(r)
+        path = _cache_path(system, prompt)
+        cached = _cache_get(path)
+        if cached:
+            texts[str(i)] = cached
+            continue
+        paths[str(i)] = path
+        lines.append(json.dumps({
+            "key": str(i),
+            "request": {
+                "system_instruction": {"parts": [{"text": system}]},
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generation_config": {
+                    "temperature": 0.7, "max_output_tokens": 500},
+            },
+        }))
+    if not lines:
+        return texts
+
+    client = _clients[_next_key()]
+    src = await client.aio.files.upload(
+        file=io.BytesIO(_NL.join(lines).encode("utf-8")),
+        config=types.UploadFileConfig(
+            display_name="n2t-reports", mime_type="jsonl"))
+    job = await client.aio.batches.create(
+        model=GEMINI_MODEL, src=src.name,
+        config=types.CreateBatchJobConfig(display_name="n2t-reports"))
+    log.info(f"Gemini batch {job.name}: {len(lines)} reports queued")
+
+    while job.state not in _BATCH_DONE:
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        job = await client.aio.batches.get(name=job.name)
+
+    if job.state not in (types.JobState.JOB_STATE_SUCCEEDED,
+                         types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED):
+        log.warning(f"Gemini batch {job.name} ended as {job.state.name}")
+        return texts
+
+    raw = await client.aio.files.download(file=job.dest.file_name)
+    for line in raw.decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        cands = item.get("response", {}).get("candidates") or [{}]
+        parts = cands[0].get("content", {}).get("parts", [])
+        text = "".join(p.get("text", "") for p in parts).strip()
+        key = item.get("key")
+        if text and len(text) > 30 and key in paths:
+            texts[key] = text
+            _cache_put(paths[key], text)
+    return texts
+
+
+TEMPLATE_SRC = """\
+Hi {{ first }},
+
+Here's your feedback for HW{{ result.project_num }} -- {{ project_name }}:
+
+{% if zip_issue %}
+NOTE on zip naming: {{ zip_issue }}
+
+{% endif %}
+{% if packaging %}
+NOTE on submission packaging:
+{% for w in packaging %}
+  {{ w }}
+{% endfor %}
+
+{% endif %}
+{% if fixable %}
+NOTE on file naming:
+{% for m in fixable %}
+  {{ m.issue }}
+{% endfor %}
+  Please use exact filenames next time (case-sensitive).
+
+{% endif %}
+{% if result.percentage == 100 and not result.has_naming_issues %}
+Perfect score! All tests pass. Excellent work.
+
+{% elif result.percentage == 100 %}
+All tests pass! Just fix the naming next time.
+
+{% else %}
+{% if passed %}
+Passing ({{ passed|length }}/{{ result.chips|length }}): \
+{{ passed|join(", ") }}
+
+{% endif %}
+{% if partial %}
+Partial credit:
+{% for c, h in partial %}
+{% if c.error_type == "mismatch" and c.passed_tests > 0 %}
+  {{ c.name }}: {{ c.passed_tests }}/{{ c.total_tests }} tests \
+({{ c.points }}/{{ c.max_points }} pts)
+{% else %}
+  {{ c.name }}: effort credit ({{ c.points }}/{{ c.max_points }} pts)
+{% endif %}
+{% if h %}
+    Hint: {{ h }}
+{% endif %}
+{% endfor %}
+
+{% endif %}
+{% if zero %}
+Needs work:
+{% for c, h in zero %}
+{% if c.error_type == "missing" %}
+  {{ c.name }}: Not found in your zip.
+{% elif c.error_type == "mismatch" %}
+  {{ c.name }}: All tests failed.
+{% elif c.error_type == "builtin" %}
+  {{ c.name }}: Uses BUILTIN -- implement yourself.
+{% elif c.error_type == "syntax" %}
+  {{ c.name }}: Syntax error -- {{ c.error_msg[:60] }}
+{% elif c.error_type == "timeout" %}
+  {{ c.name }}: Timed out.
+{% endif %}
+{% if h %}
+    Hint: {{ h }}
+{% endif %}
+{% endfor %}
+{% endif %}
+{% if cascade %}
+
+{% for w in cascade %}
+  Note: {{ w }}
+{% endfor %}
+{% endif %}
+
+Fix earlier components first.
+
+{% endif %}
+{% if result.extra_files %}
+Extra files (not needed): {{ result.extra_files|join(", ") }}
+
+{% endif %}
+Questions? Don't hesitate to reach out!
+
+-- A.Razkalla --
+"""
+
+_TPL = jinja2.Environment(
+    autoescape=False, trim_blocks=True, lstrip_blocks=True,
+).from_string(TEMPLATE_SRC)
+
+
+def _template_context(result):
+    packaging = [w[11:] if w.startswith("Packaging: ") else w
+                 for w in result.packaging_warnings]
+    pn = result.project_num
+    passed, partial, zero = [], [], []
+    for c in result.chips:
+        if c.passed:
+            passed.append(c.name)
+        elif c.points > 0:
+            partial.append((c, _HINT.get((pn, c.name), "")))
+        else:
+            zero.append((c, _HINT.get((pn, c.name), "")))
+    zip_issue = ""
     if result.zip_naming and not result.zip_naming.is_correct:
-        lines.append(f"NOTE on zip naming: {result.zip_naming.issue}\n")
-
-    # Submission packaging
-    packaging = [w for w in result.warnings if w.startswith("Packaging:")]
-    if packaging:
-        lines.append("NOTE on submission packaging:")
-        for w in packaging:
-            if w.startswith("Packaging: "):
-                lines.append(f"  {w[11:]}")
-            else:
-                lines.append(f"  {w}")
-        lines.append("")
-
-    # File naming
-    fixable = [m for m in result.naming_issues
-                if m.match_type != "not_found"]
-    if fixable:
-        lines.append("NOTE on file naming:")
-        for m in fixable:
-            lines.append(f"  {m.issue}")
-        lines.append("  Please use exact filenames next time "
-                      "(case-sensitive).\n")
-
-    if result.percentage == 100 and not result.has_naming_issues:
-        lines.append("Perfect score! All tests pass. Excellent work.\n")
-    elif result.percentage == 100:
-        lines.append("All tests pass! Just fix the naming next time.\n")
-    else:
-        passed = result.passed_names
-        failed = result.failed
-        partial = [c for c in failed if c.points > 0]
-        zero = [c for c in failed if c.points == 0]
-
-        if passed:
-            lines.append(f"Passing ({len(passed)}/{len(result.chips)}): "
-                         f"{', '.join(passed)}\n")
-
-        if partial:
-            lines.append("Partial credit:")
-            for c in partial:
-                h = hints.get(c.name, "")
-                if c.error_type == "mismatch" and c.passed_tests > 0:
-                    lines.append(
-                        f"  {c.name}: {c.passed_tests}/{c.total_tests} "
-                        f"tests ({c.points}/{c.max_points} pts)")
-                else:
-                    lines.append(
-                        f"  {c.name}: effort credit "
-                        f"({c.points}/{c.max_points} pts)")
-                if h:
-                    lines.append(f"    Hint: {h}")
-            lines.append("")
-
-        if zero:
-            lines.append("Needs work:")
-            for c in zero:
-                h = hints.get(c.name, "")
-                if c.error_type == "missing":
-                    lines.append(f"  {c.name}: Not found in your zip.")
-                elif c.error_type == "mismatch":
-                    lines.append(f"  {c.name}: All tests failed.")
-                elif c.error_type == "builtin":
-                    lines.append(f"  {c.name}: Uses BUILTIN -- "
-                                 "implement yourself.")
-                elif c.error_type == "syntax":
-                    lines.append(f"  {c.name}: Syntax error -- "
-                                 f"{c.error_msg[:60]}")
-                elif c.error_type == "timeout":
-                    lines.append(f"  {c.name}: Timed out.")
-                if h:
-                    lines.append(f"    Hint: {h}")
-
-        cascade = [w for w in result.warnings
-                   if not w.startswith("Naming:")
-                   and not w.startswith("Packaging:")]
-        if cascade:
-            lines.append("")
-            for w in cascade:
-                lines.append(f"  Note: {w}")
-        lines.append("\nFix earlier components first.\n")
-
-    if result.extra_files:
-        lines.append(f"Extra files (not needed): "
-                     f"{', '.join(result.extra_files)}\n")
-
-    lines.append("Questions? Don't hesitate to reach out!\n")
-    lines.append("-- A.Razkalla --")
-    return '\n'.join(lines)
+        zip_issue = result.zip_naming.issue
+    return {
+        "result": result,
+        "first": _first_name(result),
+        "project_name": get_project(pn)["name"],
+        "zip_issue": zip_issue,
+        "packaging": packaging,
+        "fixable": [m for m in result.naming_issues
+                    if m.match_type != "not_found"],
+        "passed": passed,
+        "partial": partial,
+        "zero": zero,
+        "cascade": result.cascade_warnings,
+    }
+
+
+_PERFECT = (
+    "Hi {first},\n\n"
+    "Here's your feedback for HW{num} -- {name}:\n\n"
+    "Perfect score! All tests pass. Excellent work.\n\n"
+    "Questions? Don't hesitate to reach out!\n\n"
+    "-- A.Razkalla --")
+
+
+def _first_name(result):
+    return result.student_name.split()[0] if result.student_name else "there"
+
+
+def _template(result):
+    # Most common case for strong students: nothing to report but the score.
+    if result.percentage == 100 and not result.has_naming_issues \
+            and not result.extra_files \
+            and not result.packaging_warnings:
+        return _PERFECT.format(
+            first=_first_name(result), num=result.project_num,
+            name=get_project(result.project_num)["name"])
+    return _TPL.render(_template_context(result))
+
+
+_EMOJI_TABLE = ((100, "🌟"), (80, "✅"), (50, "⚠️"), (0, "❌"))
 
 
 def format_header(result):
     pct = result.percentage
-    np = len(result.passed_names)
-    npar = len([c for c in result.chips if not c.passed and c.points > 0])
+    np = npar = 0
+    for c in result.chips:
+        if c.passed:
+            np += 1
+        elif c.points > 0:
+            npar += 1
     nt = len(result.chips)
 
-    if pct == 100: emoji = "🌟"
-    elif pct >= 80: emoji = "✅"
-    elif pct >= 50: emoji = "⚠️"
-    else: emoji = "❌"
+    emoji = next(e for t, e in _EMOJI_TABLE if pct >= t)
 
     parts = [f"{np} pass"]
     if npar: parts.append(f"{npar} partial")
@@ -2,23 +2,22 @@
 nand2tetris Auto-Grader Bot — Constructor University CH-234
 """
 
-import os
 import re
+import time
 import asyncio
-import tempfile
 import logging
 
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand,
 )
 from telegram.ext import (
-    Application, CommandHandler, CallbackQueryHandler,
+    AIORateLimiter, Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, ConversationHandler, filters,
 )
 
 from config import (
     TELEGRAM_TOKEN, ALLOWED_USER_IDS, TOTAL_POINTS,
-    DEFAULT_GROUP, ACTIVE_PROJECT, PROJECTS,
+    DEFAULT_GROUP, ACTIVE_PROJECT, PROJECTS, GRADE_CONCURRENCY,
     get_project, detect_project, validate_config,
 )
 import moodle_client as moodle
@@ -33,6 +32,25 @@ log = logging.getLogger("bot")
 
 PICK_COURSE, PICK_ASSIGN, PICK_GROUP, REVIEWING, TYPING_GRADE = range(5)
 
+# Minimum seconds between edits of the grading progress message.
+STATUS_EDIT_INTERVAL = 2
+# Archives downloaded ahead of the graders during a batch.
+PREFETCH_ARCHIVES = 4
+# Graded rows are saved in chunks of this size while the batch runs.
+SAVE_CHUNK = 8
+
+# Reports shown in Telegram are capped so the review card (header +
+# report) fits the 4096-char message limit; Moodle gets the full text.
+MAX_REPORT_CHARS = 3600
+
+_NL_TO_BR = str.maketrans({"\n": "<br>"})
+
+
+def _clip_report(report):
+    if len(report) > MAX_REPORT_CHARS:
+        return report[:MAX_REPORT_CHARS - 50] + "\n\n... (truncated)"
+    return report
+
 
 def auth(func):
     async def wrap(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -73,6 +91,23 @@ async def cmd_test(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await msg.edit_text(f"Failed: {e}")
 
 
+def _course_kb(courses):
+    shown = courses[:15]
+    return InlineKeyboardMarkup([[InlineKeyboardButton(
+        f"{c.get('shortname','')} -- {c['fullname'][:40]}",
+        callback_data=f"c_{c['id']}")] for c in shown])
+
+
+def _build_review_kb(rid, score, total_pts):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"✅ Submit {score}/{total_pts}",
+                              callback_data=f"sub_{rid}_{score}")],
+        [InlineKeyboardButton("✏️ Change Grade", callback_data=f"edit_{rid}"),
+         InlineKeyboardButton("📋 Copy Report", callback_data=f"copy_{rid}")],
+        [InlineKeyboardButton("⏭ Skip", callback_data=f"skip_{rid}")],
+    ])
+
+
 @auth
 async def cmd_grade(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     ctx.user_data["regrade_mode"] = False
@@ -86,11 +121,8 @@ async def cmd_grade(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await msg.edit_text("No courses found.")
         return ConversationHandler.END
     ctx.user_data["courses"] = {c["id"]: c for c in courses}
-    buttons = [[InlineKeyboardButton(
-        f"{c.get('shortname','')} -- {c['fullname'][:40]}",
-        callback_data=f"c_{c['id']}")] for c in courses[:15]]
     await msg.edit_text("Select a course:",
-                        reply_markup=InlineKeyboardMarkup(buttons))
+                        reply_markup=_course_kb(courses))
     return PICK_COURSE
 
 
@@ -107,11 +139,8 @@ async def cmd_regrade(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await msg.edit_text("No courses found.")
         return ConversationHandler.END
     ctx.user_data["courses"] = {c["id"]: c for c in courses}
-    buttons = [[InlineKeyboardButton(
-        f"{c.get('shortname','')} -- {c['fullname'][:40]}",
-        callback_data=f"c_{c['id']}")] for c in courses[:15]]
     await msg.edit_text("Select a course:",
-                        reply_markup=InlineKeyboardMarkup(buttons))
+                        reply_markup=_course_kb(courses))
     return PICK_COURSE
 
 
@@ -130,6 +159,9 @@ async def pick_course(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text("No assignments found.")
         return ConversationHandler.END
     ctx.user_data["assigns"] = {a.assign_id: a for a in assigns}
+    # Detect projects now, while the user is still picking an assignment.
+    ctx.user_data["detected"] = {
+        a.assign_id: detect_project(a.name) for a in assigns}
     buttons = [[InlineKeyboardButton(
         a.name[:50], callback_data=f"a_{a.assign_id}")]
         for a in assigns]
@@ -146,7 +178,7 @@ async def pick_assign(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     ctx.user_data["assign"] = assign
 
     # Auto-detect project
-    detected = detect_project(assign.name)
+    detected = ctx.user_data.get("detected", {}).get(aid)
     if detected:
         ctx.user_data["project_num"] = detected["number"]
         log.info(f"Auto-detected Project {detected['number']}: "
@@ -165,12 +197,10 @@ async def pick_assign(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             f"Detected: HW{proj['number']} -- {proj['name']}\n"
             f"Looking for group {DEFAULT_GROUP}...")
         try:
-            group = await moodle.find_group_by_name(aid, DEFAULT_GROUP)
+            group, member_ids = await moodle.find_group_with_members(
+                aid, DEFAULT_GROUP)
             if group:
                 ctx.user_data["group"] = group
-                member_ids = \
-                    await moodle.get_group_member_ids_from_assignment(
-                        aid, group.group_id)
                 ctx.user_data["group_member_ids"] = member_ids
                 buttons = [
                     [InlineKeyboardButton(
@@ -278,29 +308,30 @@ async def _start_grading(q, ctx):
             f"Fetching ungraded submissions for:\n"
             f"{assign.name}{group_label}")
 
-    try:
-        if regrade_mode:
-            subs = await moodle.get_submissions(aid, group_member_ids)
-        else:
-            subs = await moodle.get_ungraded(aid, group_member_ids)
-    except Exception as e:
-        await q.edit_message_text(f"Error: {e}")
-        return ConversationHandler.END
+    # The local history lookup (only needed when resuming) overlaps the
+    # Moodle round trip.
+    fetch = moodle.get_submissions if regrade_mode else moodle.get_ungraded
+    lookups = [fetch(aid, group_member_ids)]
+    if not regrade_mode:
+        lookups.append(db.get_submitted_user_ids_for_assignment(aid))
+    subs, *history = await asyncio.gather(*lookups, return_exceptions=True)
+    for res in (subs, *history):
+        if isinstance(res, Exception):
+            await q.edit_message_text(f"Error: {res}")
+            return ConversationHandler.END
+    previously_submitted_ids = history[0] if history else set()
 
     # Resume behavior: avoid re-grading users already submitted in
     # previous local sessions for the same assignment.
     skipped_local = 0
-    if not regrade_mode:
-        previously_submitted_ids = \
-            await db.get_submitted_user_ids_for_assignment(aid)
-        if previously_submitted_ids:
-            before = len(subs)
-            subs = [s for s in subs if s.user_id not in previously_submitted_ids]
-            skipped_local = before - len(subs)
-            if skipped_local > 0:
-                log.info(
-                    f"Filtered {skipped_local} already-submitted students "
-                    f"from local session history (assignment {aid})")
+    if not regrade_mode and previously_submitted_ids:
+        before = len(subs)
+        subs = [s for s in subs if s.user_id not in previously_submitted_ids]
+        skipped_local = before - len(subs)
+        if skipped_local > 0:
+            log.info(
+                f"Filtered {skipped_local} already-submitted students "
+                f"from local session history (assignment {aid})")
 
     if not subs:
         if regrade_mode:
@@ -334,75 +365,107 @@ async def _start_grading(q, ctx):
     session_id = await db.create_session(
         aid, assign.name, proj["number"])
     ctx.user_data["session_id"] = session_id
-    queue = []
-
-    for i, sub in enumerate(subs):
-        try:
-            await status.edit_text(
-                f"Grading {i+1}/{len(subs)}: {sub.full_name}...")
-        except Exception:
-            pass
-
-        archive_file = next(
-            (f for f in sub.files if f.filename.lower().endswith(
-                ('.zip', '.rar'))),
-            None)
-
-        if not archive_file:
-            rid = await db.save_result(
-                session_id, sub.user_id, sub.full_name,
-                0, [], "No supported archive (.zip/.rar) in submission.")
-            queue.append({
-                "rid": rid, "name": sub.full_name, "uid": sub.user_id,
-                "score": 0,
-                "report": "No supported archive (.zip/.rar) found in "
-                          "submission.",
-                "header": f"❌ {sub.full_name}\n"
-                          f"Score: 0/{total_pts} (0%)"})
-            continue
-
-        suffix = ".rar" if archive_file.filename.lower().endswith(
-            ".rar") else ".zip"
-        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-        try:
-            await moodle.download_file(archive_file, tmp.name)
-            tmp.close()
-
-            gr = await engine.grade_student(
-                tmp.name, sub.full_name, sub.user_id,
-                project_num=ctx.user_data.get("project_num"),
-                zip_filename=archive_file.filename)
-
-            report = await ai.generate_report(gr)
-            header = ai.format_header(gr)
-
-            chips = [{"name": c.name, "passed": c.passed,
-                      "pts": c.points, "max": c.max_points,
-                      "err": c.error_type, "msg": c.error_msg}
-                     for c in gr.chips]
-
-            rid = await db.save_result(
-                session_id, sub.user_id, sub.full_name,
-                gr.total_earned, chips, report)
-
-            queue.append({
-                "rid": rid, "name": sub.full_name, "uid": sub.user_id,
-                "score": gr.total_earned, "report": report,
-                "header": header})
-
-        except Exception as e:
-            log.error(f"Error grading {sub.full_name}: {e}",
-                      exc_info=True)
-            rid = await db.save_result(
-                session_id, sub.user_id, sub.full_name,
-                0, [], f"Error: {str(e)[:200]}")
-            queue.append({
-                "rid": rid, "name": sub.full_name, "uid": sub.user_id,
-                "score": 0,
-                "report": f"Grading error: {str(e)[:200]}",
-                "header": f"⚠️ {sub.full_name}\nGrading error"})
-        finally:
-            os.unlink(tmp.name)
+    # Set by /cancel while the batch runs (see cmd_cancel_batch).
+    ctx.user_data["cancel_batch"] = False
+
+    # One producer downloads archives ahead of GRADE_CONCURRENCY graders;
+    # the bounded queue caps how many archives sit in memory at once.
+    # Progress edits are throttled for Telegram.
+    work = asyncio.Queue(maxsize=PREFETCH_ARCHIVES)
+    workers = min(GRADE_CONCURRENCY, len(subs))
+    results = [None] * len(subs)
+    pending = []
+    save_lock = asyncio.Lock()
+    progress_lock = asyncio.Lock()
+    done = 0
+    last_edit = 0.0
+
+    saving = None
+
+    async def save(batch):
+        rids = await db.save_results_bulk(
+            session_id, [row for row, _ in batch])
+        del pending[:len(batch)]
+        for (_, item), rid in zip(batch, rids):
+            item["rid"] = rid
+
+    async def flush():
+        # Rows leave ``pending`` only once saved, so a failed write is
+        # retried by the final flush. A save is shielded: if its consumer
+        # is cancelled, the final flush waits for it rather than writing
+        # the same rows again.
+        nonlocal saving
+        async with save_lock:
+            if saving is not None:
+                await asyncio.gather(saving, return_exceptions=True)
+            if not pending:
+                return
+            saving = asyncio.ensure_future(save(pending[:]))
+            await asyncio.shield(saving)
+
+    async def producer():
+        for i, sub in enumerate(subs):
+            if ctx.user_data["cancel_batch"]:
+                break
+            data = None
+            if sub.archive_file:
+                try:
+                    data = await moodle.download_bytes(sub.archive_file)
+                except Exception as e:
+                    data = e
+            await work.put((i, sub, data))
+        for _ in range(workers):
+            await work.put(None)
+
+    async def consumer():
+        nonlocal done, last_edit
+        while (job := await work.get()) is not None:
+            if ctx.user_data["cancel_batch"]:
+                continue  # drain prefetched archives without grading
+            i, sub, data = job
+            try:
+                results[i] = await _grade_one(sub, data, proj["number"],
+                                              total_pts)
+            except Exception as e:
+                log.error(f"Could not grade {sub.full_name}: {e}",
+                          exc_info=True)
+                results[i] = _grading_error(sub, e)
+            pending.append(results[i])
+            if len(pending) >= SAVE_CHUNK:
+                await flush()
+            async with progress_lock:
+                done += 1
+                now = time.monotonic()
+                if now - last_edit >= STATUS_EDIT_INTERVAL:
+                    last_edit = now
+                    try:
+                        await status.edit_text(
+                            f"Graded {done}/{len(subs)}: {sub.full_name}")
+                    except Exception:
+                        pass
+
+    # Each flush is one transaction; whatever was graded is kept even if
+    # the batch is cut short. The task group cancels every other worker
+    # (and the producer) as soon as one fails, so nothing is still running
+    # when the final flush happens.
+    try:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(producer())
+            for _ in range(workers):
+                tg.create_task(consumer())
+    finally:
+        if saving is not None:
+            await asyncio.gather(saving, return_exceptions=True)
+        await flush()
+    queue = [res[1] for res in results if res is not None]
+
+    if ctx.user_data.pop("cancel_batch"):
+        await status.edit_text(
+            f"Batch cancelled after {len(queue)}/{len(subs)} "
+            f"submissions{group_label}.\n"
+            f"Nothing was submitted to Moodle. "
+            f"Use /grade or /regrade to start again.")
+        return ConversationHandler.END
 
     avg = sum(r["score"] for r in queue) / len(queue) if queue else 0
     await status.edit_text(
@@ -414,11 +477,63 @@ async def _start_grading(q, ctx):
     ctx.user_data["queue"] = queue
     ctx.user_data["idx"] = 0
 
-    await asyncio.sleep(1)
     await _show_next(q.message.chat_id, ctx)
     return REVIEWING
 
 
+async def _grade_one(sub, data, project_num, total_pts):
+    """Grade and report one submission from its downloaded archive.
+
+    ``data`` is the archive bytes, or the exception its download raised.
+
+    Returns ``(row, item)``: the row for ``db.save_results_bulk`` and the
+    review queue item, whose ``rid`` is filled in once the row is saved.
+    Queue items stay small; the report and header are read back from the
+    database when shown.
+    """
+    archive_file = sub.archive_file
+
+    if not archive_file:
+        row = (sub.user_id, sub.full_name, 0, [],
+               "No supported archive (.zip/.rar) found in submission.",
+               f"❌ {sub.full_name}\nScore: 0/{total_pts} (0%)")
+        return row, {"name": sub.full_name, "uid": sub.user_id, "score": 0}
+
+    try:
+        if isinstance(data, Exception):
+            raise data
+        gr = await engine.grade_student_bytes(
+            data, sub.full_name, sub.user_id,
+            project_num=project_num,
+            zip_filename=archive_file.filename)
+
+        report = await ai.generate_report(gr)
+        header = ai.format_header(gr)
+
+        chips = [{"name": c.name, "passed": c.passed,
+                  "pts": c.points, "max": c.max_points,
+                  "err": c.error_type, "msg": c.error_msg}
+                 for c in gr.chips]
+
+        row = (sub.user_id, sub.full_name, gr.total_earned, chips, report,
+               header)
+        return row, {"name": sub.full_name, "uid": sub.user_id,
+                     "score": gr.total_earned}
+
+    except Exception as e:
+        log.error(f"Error grading {sub.full_name}: {e}",
+                  exc_info=True)
+        return _grading_error(sub, e)
+
+
+def _grading_error(sub, error):
+    """Zero-score ``(row, item)`` that keeps a failed student in review."""
+    row = (sub.user_id, sub.full_name, 0, [],
+           f"Grading error: {str(error)[:200]}",
+           f"⚠️ {sub.full_name}\nGrading error")
+    return row, {"name": sub.full_name, "uid": sub.user_id, "score": 0}
+
+
 async def _show_next(chat_id, ctx):
     queue = ctx.user_data.get("queue", [])
     idx = ctx.user_data.get("idx", 0)
@@ -438,32 +553,17 @@ async def _show_next(chat_id, ctx):
         return
 
     item = queue[idx]
+    row = await db.get_result(item["rid"])
     text = (
         f"━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
         f"Review {idx+1}/{len(queue)}\n\n"
-        f"{item['header']}\n"
+        f"{row['header']}\n"
         f"━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
-        f"{item['report']}")
+        f"{_clip_report(row['report'])}")
 
-    if len(text) > 4000:
-        text = text[:3950] + "\n\n... (truncated)"
-
-    score = item["score"]
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton(
-            f"✅ Submit {score}/{total_pts}",
-            callback_data=f"sub_{item['rid']}_{score}")],
-        [InlineKeyboardButton(
-            "✏️ Change Grade",
-            callback_data=f"edit_{item['rid']}"),
-         InlineKeyboardButton(
-            "📋 Copy Report",
-            callback_data=f"copy_{item['rid']}")],
-        [InlineKeyboardButton(
-            "⏭ Skip",
-            callback_data=f"skip_{item['rid']}")],
-    ])
-    await ctx.bot.send_message(chat_id, text, reply_markup=kb)
+    await ctx.bot.send_message(
+        chat_id, text,
+        reply_markup=_build_review_kb(item["rid"], item["score"], total_pts))
 
 
 async def review_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -485,9 +585,10 @@ async def review_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         rid = int(parts[1])
         grade = float(parts[2])
         try:
+            report = (await db.get_result(rid))["report"]
             feedback_html = (
                 f"<p><strong>Score: {grade}/{total_pts}</strong></p>"
-                f"<p>{item['report'].replace(chr(10), '<br>')}</p>")
+                f"<p>{report.translate(_NL_TO_BR)}</p>")
             await moodle.submit_grade(aid, item["uid"],
                                       grade, feedback_html)
             await db.mark_submitted(rid, grade)
@@ -501,7 +602,6 @@ async def review_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return REVIEWING
 
         ctx.user_data["idx"] = idx + 1
-        await asyncio.sleep(0.5)
         await _show_next(update.effective_chat.id, ctx)
         return REVIEWING
 
@@ -511,7 +611,6 @@ async def review_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_text(
             q.message.text + "\n\n⏭ Skipped")
         ctx.user_data["idx"] = idx + 1
-        await asyncio.sleep(0.5)
         await _show_next(update.effective_chat.id, ctx)
         return REVIEWING
 
@@ -522,9 +621,9 @@ async def review_action(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return TYPING_GRADE
 
     elif data.startswith("copy_"):
-        report = item["report"]
+        report = (await db.get_result(item["rid"]))["report"]
         await q.message.reply_text(
-            f"Score: {item['score']}/{total_pts}\n\n{report}")
+            f"Score: {item['score']}/{total_pts}\n\n{_clip_report(report)}")
         return REVIEWING
 
     return REVIEWING
@@ -588,6 +687,23 @@ async def cmd_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+async def cmd_cancel_batch(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    # Runs while a grading batch is pending. PTB ignores states returned
+    # here, so the batch stops itself once it sees the flag.
+    ctx.user_data["cancel_batch"] = True
+    await update.message.reply_text(
+        "Cancelling: finishing the submissions in progress...")
+
+
+async def batch_busy(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    text = ("A grading batch is still running. "
+            "Use /status for progress or /cancel to stop it.")
+    if update.callback_query:
+        await update.callback_query.answer(text)
+    elif update.effective_message:
+        await update.effective_message.reply_text(text)
+
+
 async def post_init(app):
     await db.init_db()
     await app.bot.set_my_commands([
@@ -600,6 +716,11 @@ async def post_init(app):
     log.info("Bot initialized")
 
 
+async def post_shutdown(app):
+    await moodle.close_session()
+    await db.close_db()
+
+
 def main():
     issues = validate_config()
     for issue in issues:
@@ -613,8 +734,14 @@ def main():
     print(f"  Default group: {DEFAULT_GROUP or 'None'}")
     print(f"  Active project: {ACTIVE_PROJECT}")
 
+    # Stay under Telegram's 30 msg/s bot-wide and 20 msg/min per-chat
+    # limits when a review session fires cards and edits in bursts.
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=28, overall_time_period=1,
+        group_max_rate=18, group_time_period=60, max_retries=3)
     app = Application.builder().token(TELEGRAM_TOKEN) \
-        .post_init(post_init).build()
+        .rate_limiter(rate_limiter) \
+        .post_init(post_init).post_shutdown(post_shutdown).build()
 
     conv = ConversationHandler(
         entry_points=[
@@ -624,16 +751,25 @@ def main():
         states={
             PICK_COURSE: [
                 CallbackQueryHandler(pick_course, pattern=r"^c_")],
+            # These may run a whole grading batch; block=False keeps
+            # /status and other chats responsive meanwhile.
             PICK_ASSIGN: [
-                CallbackQueryHandler(pick_assign, pattern=r"^a_")],
+                CallbackQueryHandler(pick_assign, pattern=r"^a_",
+                                     block=False)],
             PICK_GROUP: [
-                CallbackQueryHandler(pick_group, pattern=r"^g_")],
+                CallbackQueryHandler(pick_group, pattern=r"^g_",
+                                     block=False)],
             REVIEWING: [
                 CallbackQueryHandler(review_action,
                                      pattern=r"^(sub|skip|edit|copy)_")],
             TYPING_GRADE: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND,
                                type_grade)],
+            # Updates that arrive while a batch (block=False) is running.
+            ConversationHandler.WAITING: [
+                CommandHandler("cancel", cmd_cancel_batch),
+                CallbackQueryHandler(batch_busy),
+                MessageHandler(filters.ALL, batch_busy)],
         },
         fallbacks=[CommandHandler("cancel", cmd_cancel)],
         per_message=False,
@@ -2,6 +2,7 @@ import os
 import re
 import shutil
 from pathlib import Path
+from types import MappingProxyType
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -16,17 +17,33 @@ TEST_FILES_DIR = BASE_DIR / "grader_test_files"
 DATA_DIR = BASE_DIR / "data"
 DATA_DIR.mkdir(exist_ok=True)
 DB_PATH = DATA_DIR / "grader.db"
+REPORT_CACHE_DIR = DATA_DIR / "report_cache"
 
 # ── Credentials ──────────────────────────────────────────────
 MOODLE_URL = os.getenv("MOODLE_URL", "https://elearning.constructor.university")
 MOODLE_TOKEN = os.getenv("MOODLE_TOKEN", "")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
-ALLOWED_USER_IDS = [
+GEMINI_API_KEYS = [
+    k.strip() for k in os.getenv("GEMINI_API_KEYS", GEMINI_API_KEY).split(",")
+    if k.strip()
+]
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+ALLOWED_USER_IDS = frozenset(
     int(x.strip()) for x in os.getenv("ALLOWED_USER_IDS", "").split(",")
     if x.strip().isdigit()
-]
+)
 DEFAULT_GROUP = os.getenv("DEFAULT_GROUP", "Group_G")
+# At least one grader, or a batch would wait on its download queue forever.
+GRADE_CONCURRENCY = max(1, int(os.getenv("GRADE_CONCURRENCY", "6")))
+SIM_WORKERS = int(os.getenv("SIM_WORKERS", str(os.cpu_count() or 4)))
+# Passed to every simulator JVM: the test scripts are tiny, so start-up cost
+# dominates and the C1-only / serial-GC / CDS settings start fastest.
+SIM_JAVA_OPTS = os.getenv(
+    "SIM_JAVA_OPTS",
+    "-XX:TieredStopAtLevel=1 -XX:+UseSerialGC -Xshare:auto "
+    "-Djava.awt.headless=true")
 
 # ── Project Definitions ─────────────────────────────────────
 PROJECTS = {
@@ -160,39 +177,58 @@ PROJECT_KEYWORDS = {
 }
 
 
-def get_project(project_num: int = None) -> dict:
-    """Get project config with computed fields."""
-    num = project_num or ACTIVE_PROJECT
-    proj = PROJECTS.get(num)
-    if not proj:
-        raise ValueError(f"Project {num} not defined")
+_SIM_PATHS = {
+    "HardwareSimulator": HARDWARE_SIM,
+    "CPUEmulator": CPU_EMULATOR,
+    "VMEmulator": VM_EMULATOR,
+}
+
+
+def _build_project(num: int, proj: dict) -> MappingProxyType:
+    # Chip order is kept as declared: it is the grading and report order.
     proj = dict(proj)
     proj["number"] = num
-    proj["chip_names"] = [c[0] for c in proj["chips"]]
-    proj["chip_points"] = {c[0]: c[1] for c in proj["chips"]}
+    proj["chip_names"] = tuple(c[0] for c in proj["chips"])
+    proj["chip_points"] = MappingProxyType({c[0]: c[1] for c in proj["chips"]})
     proj["total_points"] = round(sum(c[1] for c in proj["chips"]), 2)
     proj["test_path"] = TEST_FILES_DIR / proj["test_dir"]
-    sim_map = {
-        "HardwareSimulator": HARDWARE_SIM,
-        "CPUEmulator": CPU_EMULATOR,
-        "VMEmulator": VM_EMULATOR,
-    }
-    proj["simulator_path"] = sim_map.get(proj["simulator"], HARDWARE_SIM)
-    return proj
+    proj["simulator_path"] = _SIM_PATHS.get(proj["simulator"], HARDWARE_SIM)
+    return MappingProxyType(proj)
+
+
+# Project configs with computed fields, built once at import (read-only).
+_PROJECT_CACHE = {num: _build_project(num, p) for num, p in PROJECTS.items()}
+
+
+def get_project(project_num: int = None) -> MappingProxyType:
+    """Get project config with computed fields (shared; read-only)."""
+    num = project_num or ACTIVE_PROJECT
+    try:
+        return _PROJECT_CACHE[num]
+    except KeyError:
+        raise ValueError(f"Project {num} not defined") from None
+
+
+_HW_RE = re.compile(r'(?:homework|hw|project)\s*#?\s*(\d+)')
+# One alternation per project, checked in project order so that earlier
+# projects keep priority when a name matches several keyword lists.
+_KW_RES = [
+    (num, re.compile("|".join(map(re.escape, keywords))))
+    for num, keywords in PROJECT_KEYWORDS.items()
+]
 
 
 def detect_project(assignment_name: str) -> dict | None:
     """Auto-detect project from Moodle assignment name."""
     name_lower = assignment_name.lower()
-    hw_match = re.search(r'(?:homework|hw|project)\s*#?\s*(\d+)', name_lower)
+    hw_match = _HW_RE.search(name_lower)
     if hw_match:
         num = int(hw_match.group(1))
         if num in PROJECTS:
             return get_project(num)
-    for num, keywords in PROJECT_KEYWORDS.items():
-        for kw in keywords:
-            if kw in name_lower:
-                return get_project(num)
+    for num, kw_re in _KW_RES:
+        if kw_re.search(name_lower):
+            return get_project(num)
     return None
 
 
@@ -209,7 +245,7 @@ def validate_config():
         issues.append("MOODLE_TOKEN not set")
     if not TELEGRAM_TOKEN:
         issues.append("TELEGRAM_TOKEN not set")
-    if not GEMINI_API_KEY:
+    if not GEMINI_API_KEYS:
         issues.append("GEMINI_API_KEY not set (will use template reports)")
     if not ALLOWED_USER_IDS:
         issues.append("ALLOWED_USER_IDS not set (bot open to everyone)")
@@ -1,13 +1,63 @@
 """SQLite state management."""
 
 import aiosqlite
+import asyncio
 import json
 import time
 from config import DB_PATH
 
+try:
+    import orjson
+
+    def _dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:  # optional speed-up; stdlib output is equivalent
+    def _dumps(obj):
+        return json.dumps(obj)
+
+# journal_mode=WAL is stored in the file (set by init_db); these settings
+# are per connection and applied when the shared connection is opened.
+_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+)
+
+_db: aiosqlite.Connection | None = None
+_db_lock = asyncio.Lock()
+# Writers share one connection, so a commit from one call must not land in
+# the middle of another's statements.
+_write_lock = asyncio.Lock()
+
+
+async def get_db():
+    global _db
+    async with _db_lock:
+        if _db is None:
+            _db = await aiosqlite.connect(DB_PATH)
+            # Set once for the shared connection; Row still indexes by
+            # position for the queries that read row[0].
+            _db.row_factory = aiosqlite.Row
+            for pragma in _PRAGMAS:
+                await _db.execute(pragma)
+    return _db
+
+
+async def close_db():
+    global _db
+    async with _db_lock:
+        if _db is not None:
+            await _db.close()
+            _db = None
+
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = await get_db()
+    async with _write_lock:
+        # WAL persists in the file; readers no longer block the writer.
+        await db.execute("PRAGMA journal_mode=WAL")
         await db.executescript("""
             CREATE TABLE IF NOT EXISTS sessions (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -22,36 +72,83 @@ async def init_db():
                 score REAL, max_score REAL DEFAULT 10.0,
                 chip_data TEXT, report TEXT,
                 status TEXT DEFAULT 'pending',
-                submitted_grade REAL, submitted_at REAL
+                submitted_grade REAL, submitted_at REAL,
+                header TEXT
             );
+            -- Covers the session summary aggregate without touching rows.
+            CREATE INDEX IF NOT EXISTS idx_results_session
+                ON results(session_id, status, score);
+            CREATE INDEX IF NOT EXISTS idx_results_user
+                ON results(user_id);
         """)
+        cur = await db.execute("PRAGMA table_info(results)")
+        if "header" not in {row[1] for row in await cur.fetchall()}:
+            await db.execute("ALTER TABLE results ADD COLUMN header TEXT")
         await db.commit()
 
 
 async def create_session(assign_id, name, project_num=1):
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = await get_db()
+    async with _write_lock:
         cur = await db.execute(
             "INSERT INTO sessions "
             "(assign_id,assign_name,project_num,started_at) "
             "VALUES (?,?,?,?)",
             (assign_id, name, project_num, time.time()))
         await db.commit()
-        return cur.lastrowid
+    return cur.lastrowid
 
 
-async def save_result(session_id, user_id, name, score, chips, report):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def save_result(session_id, user_id, name, score, chips, report,
+                      header=None):
+    db = await get_db()
+    async with _write_lock:
         cur = await db.execute(
             "INSERT INTO results "
-            "(session_id,user_id,student_name,score,chip_data,report) "
-            "VALUES (?,?,?,?,?,?)",
-            (session_id, user_id, name, score, json.dumps(chips), report))
+            "(session_id,user_id,student_name,score,chip_data,report,header) "
+            "VALUES (?,?,?,?,?,?,?)",
+            (session_id, user_id, name, score, _dumps(chips), report,
+             header))
         await db.commit()
-        return cur.lastrowid
+    return cur.lastrowid
+
+
+async def save_results_bulk(session_id, rows):
+    """Insert ``(user_id, name, score, chips, report, header)`` rows in one
+    transaction; returns their ids in order."""
+    if not rows:
+        return []
+    db = await get_db()
+    async with _write_lock:
+        await db.executemany(
+            "INSERT INTO results "
+            "(session_id,user_id,student_name,score,chip_data,report,"
+            "header) VALUES (?,?,?,?,?,?,?)",
+            [(session_id, user_id, name, score, _dumps(chips),
+              report, header)
+             for user_id, name, score, chips, report, header in rows])
+        # executemany leaves lastrowid unset; one writer inside one
+        # transaction means the new ids are consecutive.
+        cur = await db.execute("SELECT last_insert_rowid()")
+        last = (await cur.fetchone())[0]
+        await db.commit()
+        # Cheap: only re-analyzes tables whose stats have drifted.
+        await db.execute("PRAGMA optimize")
+    return list(range(last - len(rows) + 1, last + 1))
+
+
+async def get_result(result_id):
+    db = await get_db()
+    cur = await db.execute(
+        "SELECT score, report, header FROM results WHERE id=?",
+        (result_id,))
+    row = await cur.fetchone()
+    return dict(row) if row else {}
 
 
 async def mark_submitted(result_id, grade):
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = await get_db()
+    async with _write_lock:
         await db.execute(
             "UPDATE results SET status='submitted',"
             "submitted_grade=?,submitted_at=? WHERE id=?",
@@ -60,7 +157,8 @@ async def mark_submitted(result_id, grade):
 
 
 async def mark_skipped(result_id):
-    async with aiosqlite.connect(DB_PATH) as db:
+    db = await get_db()
+    async with _write_lock:
         await db.execute(
             "UPDATE results SET status='skipped' WHERE id=?",
             (result_id,))
@@ -68,28 +166,27 @@ async def mark_skipped(result_id):
 
 
 async def get_submitted_user_ids_for_assignment(assign_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-            SELECT DISTINCT r.user_id
-            FROM results r
-            JOIN sessions s ON s.id = r.session_id
-            WHERE s.assign_id = ?
-              AND r.status = 'submitted'
-              AND r.user_id IS NOT NULL
-        """, (assign_id,))
-        rows = await cur.fetchall()
-        return {row[0] for row in rows}
+    db = await get_db()
+    cur = await db.execute("""
+        SELECT DISTINCT r.user_id
+        FROM results r
+        JOIN sessions s ON s.id = r.session_id
+        WHERE s.assign_id = ?
+          AND r.status = 'submitted'
+          AND r.user_id IS NOT NULL
+    """, (assign_id,))
+    rows = await cur.fetchall()
+    return {row[0] for row in rows}
 
 
 async def get_session_summary(session_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        db.row_factory = aiosqlite.Row
-        cur = await db.execute("""
-            SELECT COUNT(*) as total,
-                SUM(CASE WHEN status='submitted' THEN 1 ELSE 0 END) as submitted,
-                SUM(CASE WHEN status='skipped' THEN 1 ELSE 0 END) as skipped,
-                SUM(CASE WHEN status='pending' THEN 1 ELSE 0 END) as pending,
-                ROUND(AVG(score),2) as avg_score
-            FROM results WHERE session_id=?""", (session_id,))
-        row = await cur.fetchone()
-        return dict(row) if row else {}
+    db = await get_db()
+    cur = await db.execute("""
+        SELECT COUNT(*) as total,
+            COALESCE(SUM(status='submitted'),0) as submitted,
+            COALESCE(SUM(status='skipped'),0) as skipped,
+            COALESCE(SUM(status='pending'),0) as pending,
+            COALESCE(ROUND(AVG(score),2),0) as avg_score
+        FROM results WHERE session_id=?""", (session_id,))
+    # An aggregate always yields one row, zeroed for an empty session.
+    return dict(await cur.fetchone())
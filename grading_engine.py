@@ -2,7 +2,9 @@
 Core grading: extract zip, match files, run simulator, partial credit.
 """
 
+import io
 import os
+import itertools
 import re
 import shutil
 import zipfile
@@ -10,10 +12,13 @@ import asyncio
 import tempfile
 import subprocess
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 from pathlib import Path
 
-from config import get_project, ACTIVE_PROJECT, PROJECTS
+from config import (get_project, ACTIVE_PROJECT, PROJECTS, SIM_WORKERS,
+                    SIM_JAVA_OPTS)
 
 log = logging.getLogger(__name__)
 
@@ -79,6 +84,16 @@ class GradingResult:
     def naming_issues(self):
         return [m for m in self.file_matches if m.match_type != "exact"]
 
+    # Cached: only read once grading is done and warnings are final.
+    @cached_property
+    def packaging_warnings(self):
+        return [w for w in self.warnings if w.startswith("Packaging:")]
+
+    @cached_property
+    def cascade_warnings(self):
+        return [w for w in self.warnings
+                if not w.startswith(("Naming:", "Packaging:"))]
+
     @property
     def has_naming_issues(self):
         return len(self.naming_issues) > 0 or \
@@ -87,6 +102,10 @@ class GradingResult:
 
 # ── Zip Naming Check ─────────────────────────────────────────
 
+_RE_HW = {n: re.compile(rf'(?:hw|homework)\s*{n}', re.IGNORECASE)
+          for n in PROJECTS}
+
+
 def check_zip_naming(
     filename: str,
     student_name: str,
@@ -137,9 +156,7 @@ def check_zip_naming(
             expected_pattern=f"{expected}.zip")
 
     # Check if it at least contains HW number
-    hw_num_present = bool(
-        re.search(rf'(?:hw|homework)\s*{project_num}', name_no_ext,
-                  re.IGNORECASE))
+    hw_num_present = bool(_RE_HW[project_num].search(name_no_ext))
 
     # Check if student name is present (case insensitive)
     name_present = (
@@ -172,14 +189,16 @@ def check_zip_naming(
 
 # ── File Matching ────────────────────────────────────────────
 
+# Copy markers ("(1)", "copy 2") and separators, stripped in one pass;
+# then at most one trailing .asm/.hdl pair, as the separate subs did.
+_RE_NAME_JUNK = re.compile(r'\s*\(\d+\)\s*|\s*copy\s*\d*|[\s_\-]+',
+                           re.IGNORECASE)
+_RE_SRC_EXT = re.compile(r'(?:\.asm)?(?:\.hdl)?$', re.IGNORECASE)
+
+
 def _normalize(name):
-    name = name.strip()
-    name = re.sub(r'\s*\(\d+\)\s*', '', name)
-    name = re.sub(r'\s*copy\s*\d*', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'[\s_\-]+', '', name)
-    name = re.sub(r'\.hdl$', '', name, flags=re.IGNORECASE)
-    name = re.sub(r'\.asm$', '', name, flags=re.IGNORECASE)
-    return name.lower()
+    name = _RE_NAME_JUNK.sub('', name.strip())
+    return _RE_SRC_EXT.sub('', name, count=1).lower()
 
 
 def _match_files(found, expected_names, file_ext):
@@ -187,6 +206,9 @@ def _match_files(found, expected_names, file_ext):
     matches = []
     used = set()
 
+    # Lowercased once here and shared by the case-insensitive and
+    # substring passes.
+    found_items = [(name, name.lower(), path) for name, path in found.items()]
     found_norm = {}
     for name, path in found.items():
         found_norm[_normalize(name)] = (name, path)
@@ -200,8 +222,7 @@ def _match_files(found, expected_names, file_ext):
 
     # Pass 2: case insensitive
     remaining = [n for n in expected_names if n not in matched]
-    found_lower = {k.lower(): (k, v) for k, v in found.items()
-                   if k not in used}
+    found_lower = {nl: (k, v) for k, nl, v in found_items if k not in used}
     for exp in remaining[:]:
         if exp.lower() in found_lower:
             orig, path = found_lower[exp.lower()]
@@ -231,10 +252,9 @@ def _match_files(found, expected_names, file_ext):
         exp_lower = exp.lower()
         best = None
         best_score = 0
-        for name, path in found.items():
+        for name, nl, path in found_items:
             if name in used:
                 continue
-            nl = name.lower()
             if exp_lower in nl or nl in exp_lower:
                 score = len(exp_lower) / max(len(nl), 1)
                 if score > best_score:
@@ -259,18 +279,44 @@ def _match_files(found, expected_names, file_ext):
     return matched, matches, extra
 
 
+def _link_or_copy(source, dest):
+    # Sandboxes are throwaway and the simulator only creates new .out files,
+    # so a hardlink is as good as a copy; fall back across filesystems.
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+
 def _rename_for_sim(matched, sandbox, ext):
     for expected, source in matched.items():
-        shutil.copy2(source, os.path.join(sandbox, f"{expected}{ext}"))
+        _link_or_copy(source, os.path.join(sandbox, f"{expected}{ext}"))
+
+
+@lru_cache(maxsize=None)
+def _test_assets(test_path):
+    """Test/compare/support files of a project, listed once per process."""
+    return tuple((a.name, str(a)) for a in sorted(test_path.iterdir())
+                 if a.is_file())
 
 
 def _copy_test_assets(test_path, sandbox):
-    for asset in test_path.iterdir():
-        if not asset.is_file():
-            continue
-        dest = os.path.join(sandbox, asset.name)
+    for name, asset in _test_assets(test_path):
+        dest = os.path.join(sandbox, name)
         if not os.path.exists(dest):
-            shutil.copy2(asset, dest)
+            _link_or_copy(asset, dest)
+
+
+def _prepare_sandbox(tmp, matched, project):
+    """One simulator working dir per student, shared by all of its chips.
+
+    Every test writes its own ``<stem>.out``, so chips can run side by side
+    in the same directory.
+    """
+    sb = tempfile.mkdtemp(prefix="sim_", dir=tmp)
+    _rename_for_sim(matched, sb, project["file_ext"])
+    _copy_test_assets(project["test_path"], sb)
+    return sb
 
 
 # ── Helpers ──────────────────────────────────────────────────
@@ -280,17 +326,10 @@ def _is_supported_archive(name):
 
 
 def _extract_archive_once(archive_path, out_dir):
+    # Zips are handled member by member in _extract_zip_members.
     os.makedirs(out_dir, exist_ok=True)
     lower = archive_path.lower()
 
-    if lower.endswith(".zip"):
-        try:
-            with zipfile.ZipFile(archive_path, 'r') as zf:
-                zf.extractall(out_dir)
-            return True, ""
-        except zipfile.BadZipFile:
-            return False, "invalid zip file"
-
     if lower.endswith(".rar"):
         cmds = []
         if shutil.which("unrar"):
@@ -325,6 +364,17 @@ def _extract_archive_once(archive_path, out_dir):
     return False, "unsupported archive type"
 
 
+def _source_name(filename, file_ext):
+    """Chip name for a submitted source file, or None if it is not one."""
+    if not filename.lower().endswith(file_ext):
+        return None
+    name = filename
+    # Hidden extensions on Windows produce names like Not.hdl.hdl.
+    while name.lower().endswith(file_ext):
+        name = name[:-len(file_ext)]
+    return name or None
+
+
 def _scan_submission_files(base_dir, file_ext):
     found = {}
     nested_archives = []
@@ -336,27 +386,78 @@ def _scan_submission_files(base_dir, file_ext):
             full = os.path.join(root, f)
             if _is_supported_archive(f):
                 nested_archives.append(full)
-            name = f
-            while name.lower().endswith(file_ext):
-                name = name[:-len(file_ext)]
-            if f.lower().endswith(file_ext) and name:
-                if name not in found:
-                    found[name] = full
+            name = _source_name(f, file_ext)
+            if name and name not in found:
+                found[name] = full
+    return found, nested_archives
+
+
+def _extract_zip_members(archive, out_dir, file_ext):
+    """Extract only source files and nested archives, indexing as we go.
+
+    Same result as extractall + _scan_submission_files without writing
+    the unrelated members or walking the tree afterwards.
+    """
+    found = {}
+    nested_archives = []
+    with zipfile.ZipFile(archive, 'r') as zf:
+        members = []
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            # Drop the empty and "." components extractall normalises away;
+            # hidden dirs, __MACOSX and ".." still disqualify a member.
+            parts = [p for p in info.filename.split('/') if p not in ('', '.')]
+            if not parts or any(p.startswith(('.', '__')) for p in parts):
+                continue
+            base = parts[-1]
+            name = _source_name(base, file_ext)
+            if name or _is_supported_archive(base):
+                members.append((len(parts), info, name))
+        # Shallower files win name clashes, as in the top-down walk.
+        members.sort(key=lambda m: m[0])
+        for _, info, name in members:
+            if name and name in found:
+                continue
+            full = zf.extract(info, out_dir)
+            if name:
+                found[name] = full
+            else:
+                nested_archives.append(full)
     return found, nested_archives
 
 
+def _extract_and_scan(archive_path, out_dir, file_ext):
+    """Extract an archive; return (ok, err, found, nested_archives)."""
+    # File objects come from grade_student_bytes, which only passes zips.
+    lower = archive_path.lower() if isinstance(archive_path, str) else ".zip"
+    if lower.endswith(".zip"):
+        os.makedirs(out_dir, exist_ok=True)
+        try:
+            found, nested = _extract_zip_members(archive_path, out_dir,
+                                                 file_ext)
+        except zipfile.BadZipFile:
+            return False, "invalid zip file", {}, []
+        return True, "", found, nested
+    ok, err = _extract_archive_once(archive_path, out_dir)
+    if not ok:
+        return False, err, {}, []
+    found, nested = _scan_submission_files(out_dir, file_ext)
+    return True, "", found, nested
+
+
 def _extract_zip(zip_path, file_ext, archive_label=""):
     tmp = tempfile.mkdtemp(prefix="n2t_")
     warnings = []
     shown_name = archive_label or os.path.basename(zip_path)
-    ok, err = _extract_archive_once(zip_path, tmp)
+    ok, err, found, nested_archives = _extract_and_scan(
+        zip_path, tmp, file_ext)
     if not ok:
         warnings.append(
             f"Packaging: Could not extract archive "
             f"'{shown_name}' ({err}).")
         return tmp, {}, warnings
 
-    found, nested_archives = _scan_submission_files(tmp, file_ext)
     if found:
         return tmp, found, warnings
 
@@ -376,7 +477,8 @@ def _extract_zip(zip_path, file_ext, archive_label=""):
 
         nested_out = os.path.join(
             tmp, f"nested_d{depth}_{len(seen)}")
-        ok, err = _extract_archive_once(archive_path, nested_out)
+        ok, err, nested_found, nested_more = _extract_and_scan(
+            archive_path, nested_out, file_ext)
         if not ok:
             warnings.append(
                 f"Packaging: Found nested archive "
@@ -384,8 +486,6 @@ def _extract_zip(zip_path, file_ext, archive_label=""):
                 f"extract it ({err}).")
             continue
 
-        nested_found, nested_more = _scan_submission_files(
-            nested_out, file_ext)
         if nested_found:
             warnings.append(
                 f"Packaging: Detected nested archive "
@@ -404,30 +504,32 @@ def _extract_zip(zip_path, file_ext, archive_label=""):
     return tmp, found, warnings
 
 
-def _check_builtin(path):
-    try:
-        text = Path(path).read_text(encoding='utf-8', errors='ignore')
-        return bool(re.search(r'\bBUILTIN\b', text, re.IGNORECASE))
-    except Exception:
-        return False
+_RE_BUILTIN = re.compile(r'\bBUILTIN\b', re.IGNORECASE)
+_RE_COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+# Matched against raw simulator output; only error messages get decoded.
+_RE_CMP_FAIL = re.compile(rb'[Cc]omparison failure at line (\d+)')
 
 
-def _has_work(path, ext):
+def _analyze_source(path, ext):
+    """Read a submitted file once; return (uses_builtin, has_work)."""
     try:
         text = Path(path).read_text(encoding='utf-8', errors='ignore')
-        if ext == ".hdl":
-            m = re.search(r'PARTS:\s*(.*?)(?:\})', text, re.DOTALL)
-            if m:
-                parts = re.sub(r'//.*', '', m.group(1))
-                parts = re.sub(r'/\*.*?\*/', '', parts, flags=re.DOTALL)
-                return len(parts.strip()) > 0
-        elif ext == ".asm":
-            lines = [l.strip() for l in text.splitlines()
-                     if l.strip() and not l.strip().startswith('//')]
-            return len(lines) > 2
-        return False
     except Exception:
-        return False
+        return False, False
+    if ext == ".hdl":
+        builtin = bool(_RE_BUILTIN.search(text))
+        # Body between PARTS: and the first closing brace.
+        start = text.find('PARTS:')
+        end = text.find('}', start + 6) if start >= 0 else -1
+        if end < 0:
+            return builtin, False
+        parts = _RE_COMMENT.sub('', text[start + 6:end])
+        return builtin, len(parts.strip()) > 0
+    if ext == ".asm":
+        lines = [l.strip() for l in text.splitlines()
+                 if l.strip() and not l.strip().startswith('//')]
+        return False, len(lines) > 2
+    return False, False
 
 
 def _partial_credit(sandbox, chip, max_pts, test_stem=None):
@@ -436,30 +538,37 @@ def _partial_credit(sandbox, chip, max_pts, test_stem=None):
     out_p = os.path.join(sandbox, f"{stem}.out")
     if not os.path.exists(cmp_p) or not os.path.exists(out_p):
         return 0, 0, 0, 0, "", ""
+    # Stream both files side by side; rows past the end of .out count as
+    # failures, and only the first mismatch is kept.
+    total = passed = 0
+    fl, fe, fa = 0, "", ""
     try:
-        cmp = Path(cmp_p).read_text().splitlines()
-        out = Path(out_p).read_text().splitlines()
+        with open(cmp_p, buffering=1 << 16) as fc, \
+                open(out_p, buffering=1 << 16) as fo:
+            next(fc, None)
+            next(fo, None)
+            for i, (c, o) in enumerate(itertools.zip_longest(fc, fo), 1):
+                if c is None:
+                    break
+                total += 1
+                c = c.rstrip()
+                o = o.rstrip() if o is not None else ""
+                if c == o:
+                    passed += 1
+                elif fl == 0:
+                    fl, fe, fa = i, c, o
     except Exception:
         return 0, 0, 0, 0, "", ""
-    if len(cmp) < 2:
+    if not total:
         return 0, 0, 0, 0, "", ""
-    total = len(cmp) - 1
-    passed = 0
-    fl, fe, fa = 0, "", ""
-    for i in range(1, len(cmp)):
-        c = cmp[i].strip() if i < len(cmp) else ""
-        o = out[i].strip() if i < len(out) else ""
-        if c == o:
-            passed += 1
-        elif fl == 0:
-            fl, fe, fa = i, c, o
-    pts = round(max_pts * passed / total, 2) if total else 0
+    pts = round(max_pts * passed / total, 2)
     return pts, passed, total, fl, fe, fa
 
 
 def _cmp_row_count(cmp_path):
     try:
-        return max(0, len(Path(cmp_path).read_text().splitlines()) - 1)
+        with open(cmp_path, buffering=1 << 16) as f:
+            return max(0, sum(1 for _ in f) - 1)
     except Exception:
         return 0
 
@@ -470,7 +579,7 @@ def _clean_err(raw):
         l = l.strip()
         if not l or l.startswith('at ') or 'java.' in l.lower():
             continue
-        if 'Exception in thread' in l:
+        if 'Exception in thread' in l or l.startswith('Picked up '):
             continue
         lines.append(l)
     return '; '.join(lines[:3])[:200] if lines else "Unknown error"
@@ -478,43 +587,44 @@ def _clean_err(raw):
 
 # ── Test Runner ──────────────────────────────────────────────
 
-def _run_test(chip, matched, project, test_stem, max_pts):
-    pts = project["chip_points"]
+# The simulator scripts launch java themselves; JAVA_TOOL_OPTIONS is the one
+# hook every JVM honours (it echoes "Picked up ..." to stderr, see _clean_err).
+_SIM_ENV = dict(os.environ)
+if SIM_JAVA_OPTS:
+    _SIM_ENV["JAVA_TOOL_OPTIONS"] = " ".join(
+        filter(None, (_SIM_ENV.get("JAVA_TOOL_OPTIONS"), SIM_JAVA_OPTS)))
+
+
+def _run_test(chip, matched, project, test_stem, max_pts, sb, source):
     tp = project["test_path"]
     sim = str(project["simulator_path"])
-    ext = project["file_ext"]
 
     if chip not in matched:
         return ChipResult(chip, False, 0, max_pts, "missing", "Not submitted")
 
-    if ext == ".hdl" and _check_builtin(matched[chip]):
+    builtin, work = source
+    if builtin:
         return ChipResult(chip, False, 0, max_pts, "builtin",
                           "Uses BUILTIN (not allowed)")
 
-    work = _has_work(matched[chip], ext)
     tst = tp / f"{test_stem}.tst"
     cmp = tp / f"{test_stem}.cmp"
     if not tst.exists():
         return ChipResult(chip, False, 0, max_pts, "internal",
                           f"{test_stem}.tst not found")
 
-    sb = tempfile.mkdtemp(prefix=f"c_{chip}_")
     try:
-        _rename_for_sim(matched, sb, ext)
-        _copy_test_assets(tp, sb)
-
         r = subprocess.run(
             [sim, os.path.join(sb, f"{test_stem}.tst")],
-            capture_output=True, text=True, timeout=60, cwd=sb)
-        out = f"{r.stdout}\n{r.stderr}".strip()
+            capture_output=True, timeout=60, cwd=sb, env=_SIM_ENV)
+        out = r.stdout + b"\n" + r.stderr
 
-        if "Comparison ended successfully" in out or \
-           "End of script - Comparison ended successfully" in out:
+        if b"Comparison ended successfully" in out:
             tt = _cmp_row_count(cmp)
             return ChipResult(chip, True, max_pts, max_pts, "pass",
                               total_tests=tt, passed_tests=tt)
 
-        m = re.search(r'[Cc]omparison failure at line (\d+)', out)
+        m = _RE_CMP_FAIL.search(out)
         if m:
             p, ps, tt, fl, fe, fa = _partial_credit(
                 sb, chip, max_pts, test_stem=test_stem)
@@ -523,7 +633,7 @@ def _run_test(chip, matched, project, test_stem, max_pts):
                 f"{ps}/{tt} tests passed (first fail line {fl})",
                 fl, fe, fa, tt, ps)
 
-        ce = _clean_err(out)
+        ce = _clean_err(out.decode("utf-8", "replace").strip())
         if work:
             return ChipResult(chip, False, round(max_pts * 0.15, 2), max_pts,
                               "syntax", f"Syntax error (effort credit): {ce}")
@@ -535,8 +645,6 @@ def _run_test(chip, matched, project, test_stem, max_pts):
                           "Timed out (possible loop)")
     except Exception as e:
         return ChipResult(chip, False, 0, max_pts, "internal", str(e)[:150])
-    finally:
-        shutil.rmtree(sb, ignore_errors=True)
 
 
 def _merge_test_results(chip, stems, results, max_pts):
@@ -576,7 +684,7 @@ def _merge_test_results(chip, stems, results, max_pts):
         total_tests, passed_tests)
 
 
-def _run_one(chip, matched, project):
+def _run_one(chip, matched, project, sb):
     pts = project["chip_points"]
     mx = pts.get(chip, 1.0)
     tp = project["test_path"]
@@ -584,14 +692,18 @@ def _run_one(chip, matched, project):
     stems = test_map.get(chip, chip)
     if isinstance(stems, str):
         stems = [stems]
+    # Shared by every test script of the chip.
+    source = (_analyze_source(matched[chip], project["file_ext"])
+              if chip in matched else (False, False))
 
     if len(stems) == 1:
-        return _run_test(chip, matched, project, stems[0], mx)
+        return _run_test(chip, matched, project, stems[0], mx, sb, source)
 
     weights = [_cmp_row_count(tp / f"{stem}.cmp") or 1 for stem in stems]
     total_weight = sum(weights) or len(stems)
     results = [
-        _run_test(chip, matched, project, stem, mx * weight / total_weight)
+        _run_test(chip, matched, project, stem, mx * weight / total_weight,
+                  sb, source)
         for stem, weight in zip(stems, weights)
     ]
     return _merge_test_results(chip, stems, results, mx)
@@ -614,6 +726,13 @@ def _cascades(results, deps):
 
 # ── Main Pipeline ────────────────────────────────────────────
 
+# Chips are simulated in parallel. Each run mostly waits on its own JVM
+# subprocess, so threads suffice, and the shared pool caps how many
+# simulators run at once across all students being graded.
+_SIM_POOL = ThreadPoolExecutor(max_workers=SIM_WORKERS,
+                               thread_name_prefix="sim")
+
+
 async def grade_student(zip_path, student_name, user_id,
                         project_num=None, zip_filename=""):
     project = get_project(project_num)
@@ -622,8 +741,10 @@ async def grade_student(zip_path, student_name, user_id,
     ext = project["file_ext"]
     deps = project.get("deps", {})
 
-    tmp, raw, extract_warnings = _extract_zip(
-        zip_path, ext, zip_filename or os.path.basename(zip_path))
+    # Extraction (and any unrar subprocess) stays off the event loop.
+    tmp, raw, extract_warnings = await asyncio.to_thread(
+        _extract_zip, zip_path, ext,
+        zip_filename or os.path.basename(zip_path))
     try:
         result = GradingResult(
             student_name=student_name, user_id=user_id,
@@ -661,10 +782,12 @@ async def grade_student(zip_path, student_name, user_id,
                 if m.match_type in ("case_fix", "fuzzy"):
                     result.warnings.append(f"Naming: {m.issue}")
 
+        sb = await asyncio.to_thread(_prepare_sandbox, tmp, matched, project)
         loop = asyncio.get_event_loop()
-        for c in chips:
-            cr = await loop.run_in_executor(None, _run_one, c, matched,
-                                            project)
+        crs = await asyncio.gather(*(
+            loop.run_in_executor(_SIM_POOL, _run_one, c, matched, project, sb)
+            for c in chips))
+        for cr in crs:
             result.chips.append(cr)
             result.total_earned += cr.points
 
@@ -673,3 +796,23 @@ async def grade_student(zip_path, student_name, user_id,
         return result
     finally:
         shutil.rmtree(tmp, ignore_errors=True)
+
+
+async def grade_student_bytes(data, student_name, user_id,
+                              project_num=None, zip_filename=""):
+    """Grade an archive held in memory instead of a file on disk.
+
+    Zips are read straight from memory; RAR extractors only take paths,
+    so those are spilled to a temporary file first.
+    """
+    if zip_filename.lower().endswith(".rar"):
+        fd, path = tempfile.mkstemp(suffix=".rar")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            return await grade_student(path, student_name, user_id,
+                                       project_num, zip_filename)
+        finally:
+            os.unlink(path)
+    return await grade_student(io.BytesIO(data), student_name, user_id,
+                               project_num, zip_filename or "submission.zip")
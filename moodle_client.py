@@ -4,12 +4,28 @@ Uses participant data for group filtering (group API is restricted).
 """
 
 import aiohttp
+import asyncio
+import json
 import logging
+import re
+import time
 from dataclasses import dataclass, field
 from config import MOODLE_URL, MOODLE_TOKEN
 
 log = logging.getLogger(__name__)
 API = f"{MOODLE_URL}/webservice/rest/server.php"
+_ARCHIVE_RE = re.compile(r"\.(?:zip|rar)$", re.IGNORECASE)
+
+_session: aiohttp.ClientSession | None = None
+# The session's 60 s total suits API calls; archives on a slow link get
+# aiohttp's usual 300 s, and only a stalled transfer fails early.
+_DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=300, sock_connect=30,
+                                         sock_read=60)
+
+# Rosters barely change within a grading session; group lookups reuse them
+# for a minute. Grading status is read from a fresh fetch in get_submissions.
+PARTICIPANTS_TTL = 60
+_participants_cache: dict[int, tuple[float, list]] = {}
 
 
 @dataclass
@@ -28,6 +44,7 @@ class MoodleSubmission:
     grading_status: str
     time_modified: int
     files: list[MoodleFile] = field(default_factory=list)
+    archive_file: MoodleFile | None = None
 
 
 @dataclass
@@ -49,6 +66,34 @@ class MoodleGroup:
     member_count: int = 0
 
 
+async def _get_session():
+    """Shared session so calls reuse pooled keep-alive connections."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            # Review pauses between Moodle calls often exceed aiohttp's 15 s
+            # default, so keep idle connections around for a minute.
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300,
+                                           keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=60))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+class MoodleAPIError(Exception):
+    """A web service call answered with a Moodle exception object."""
+
+    def __init__(self, message, errorcode=""):
+        super().__init__(message)
+        self.errorcode = errorcode
+
+
 async def _call(session, function, **kwargs):
     params = {
         "wstoken": MOODLE_TOKEN,
@@ -60,46 +105,120 @@ async def _call(session, function, **kwargs):
         data = await resp.json(content_type=None)
         if isinstance(data, dict) and "exception" in data:
             msg = data.get("message", data.get("errorcode", "Unknown"))
-            raise Exception(f"Moodle API [{function}]: {msg}")
+            raise MoodleAPIError(f"Moodle API [{function}]: {msg}",
+                                 data.get("errorcode", ""))
         return data
 
 
+def _flatten(value, prefix):
+    """Flatten nested args into REST form keys (``ids[0]``, ``a[b]``)."""
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+    else:
+        return {prefix: value}
+    out = {}
+    for k, v in items:
+        out.update(_flatten(v, f"{prefix}[{k}]" if prefix else k))
+    return out
+
+
+_batch_supported = True
+# Error codes meaning the token's service does not expose the batch
+# function at all (access control / unknown function).
+_BATCH_UNAVAILABLE = {"accessexception", "invalidrecord",
+                      "servicenotavailable"}
+
+
+async def batch_call(session, calls):
+    """Run several web service functions in a single round trip.
+
+    ``calls`` is a list of ``(function, args)`` pairs with structured args.
+    Uses ``tool_mobile_call_external_functions``; if the token's service
+    does not expose it, falls back to one request per function. Failed
+    calls come back as Exception objects in their slot.
+    """
+    global _batch_supported
+    if _batch_supported:
+        form = {}
+        for i, (function, args) in enumerate(calls):
+            form[f"requests[{i}][function]"] = function
+            form[f"requests[{i}][arguments]"] = json.dumps(args)
+        try:
+            data = await _call(session, "tool_mobile_call_external_functions",
+                               **form)
+            results = []
+            for (function, _), r in zip(calls, data["responses"]):
+                if r.get("error"):
+                    err = json.loads(r.get("exception") or "{}")
+                    msg = err.get("message", err.get("errorcode", "Unknown"))
+                    results.append(
+                        Exception(f"Moodle API [{function}]: {msg}"))
+                else:
+                    results.append(json.loads(r["data"]))
+            return results
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise
+        except MoodleAPIError as e:
+            if e.errorcode in _BATCH_UNAVAILABLE:
+                log.info(f"Batch calls unavailable, using single calls: {e}")
+                _batch_supported = False
+            else:
+                log.warning(f"Batch call failed, retrying singly: {e}")
+        except Exception as e:
+            # Malformed reply; fall back for this call only.
+            log.warning(f"Batch call failed, retrying singly: {e}")
+    results = []
+    for function, args in calls:
+        try:
+            results.append(
+                await _call(session, function, **_flatten(args, "")))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
 async def test_connection():
-    async with aiohttp.ClientSession() as s:
-        return await _call(s, "core_webservice_get_site_info")
+    s = await _get_session()
+    return await _call(s, "core_webservice_get_site_info")
 
 
 async def get_courses():
-    async with aiohttp.ClientSession() as s:
-        info = await _call(s, "core_webservice_get_site_info")
-        return await _call(s, "core_enrol_get_users_courses",
-                           userid=info["userid"])
+    s = await _get_session()
+    info = await _call(s, "core_webservice_get_site_info")
+    return await _call(s, "core_enrol_get_users_courses",
+                       userid=info["userid"])
 
 
 async def get_assignments(course_id):
-    async with aiohttp.ClientSession() as s:
-        data = await _call(s, "mod_assign_get_assignments",
-                           **{"courseids[0]": course_id})
-        result = []
-        for course in data.get("courses", []):
-            for a in course.get("assignments", []):
-                result.append(MoodleAssignment(
-                    assign_id=a["id"], cmid=a["cmid"], name=a["name"],
-                    course_id=course["id"],
-                    course_name=course.get("fullname", ""),
-                    max_grade=float(a.get("grade", 10)),
-                    due_date=a.get("duedate", 0)))
-        return result
+    s = await _get_session()
+    data = await _call(s, "mod_assign_get_assignments",
+                       **{"courseids[0]": course_id})
+    result = []
+    for course in data.get("courses", []):
+        for a in course.get("assignments", []):
+            result.append(MoodleAssignment(
+                assign_id=a["id"], cmid=a["cmid"], name=a["name"],
+                course_id=course["id"],
+                course_name=course.get("fullname", ""),
+                max_grade=float(a.get("grade", 10)),
+                due_date=a.get("duedate", 0)))
+    return result
 
 
 async def _get_participants(assign_id):
-    async with aiohttp.ClientSession() as s:
-        return await _call(s, "mod_assign_list_participants",
-                           assignid=assign_id, groupid=0, filter="")
+    cached = _participants_cache.get(assign_id)
+    if cached and time.monotonic() - cached[0] < PARTICIPANTS_TTL:
+        return cached[1]
+    s = await _get_session()
+    participants = await _call(s, "mod_assign_list_participants",
+                               assignid=assign_id, groupid=0, filter="")
+    _participants_cache[assign_id] = (time.monotonic(), participants)
+    return participants
 
 
-async def get_groups_from_assignment(assign_id):
-    participants = await _get_participants(assign_id)
+def _groups_from_participants(participants):
     group_map = {}
     for p in participants:
         for g in p.get("groups", []):
@@ -117,8 +236,7 @@ async def get_groups_from_assignment(assign_id):
     return groups
 
 
-async def get_group_member_ids_from_assignment(assign_id, group_id):
-    participants = await _get_participants(assign_id)
+def _member_ids(participants, group_id):
     ids = set()
     for p in participants:
         for g in p.get("groups", []):
@@ -128,8 +246,7 @@ async def get_group_member_ids_from_assignment(assign_id, group_id):
     return ids
 
 
-async def find_group_by_name(assign_id, group_name):
-    groups = await get_groups_from_assignment(assign_id)
+def _match_group(groups, group_name):
     name_lower = group_name.lower().strip()
     for g in groups:
         if g.name.lower().strip() == name_lower:
@@ -140,44 +257,72 @@ async def find_group_by_name(assign_id, group_name):
     return None
 
 
+async def get_groups_from_assignment(assign_id):
+    return _groups_from_participants(await _get_participants(assign_id))
+
+
+async def get_group_member_ids_from_assignment(assign_id, group_id):
+    return _member_ids(await _get_participants(assign_id), group_id)
+
+
+async def find_group_by_name(assign_id, group_name):
+    groups = await get_groups_from_assignment(assign_id)
+    return _match_group(groups, group_name)
+
+
+async def find_group_with_members(assign_id, group_name):
+    """Resolve a group by name and its member ids from one roster fetch."""
+    participants = await _get_participants(assign_id)
+    group = _match_group(_groups_from_participants(participants), group_name)
+    if group is None:
+        return None, set()
+    return group, _member_ids(participants, group.group_id)
+
+
 async def get_submissions(assign_id, group_member_ids=None):
-    async with aiohttp.ClientSession() as s:
-        sub_data = await _call(s, "mod_assign_get_submissions",
-                               **{"assignmentids[0]": assign_id})
-        try:
-            participants = await _call(
-                s, "mod_assign_list_participants",
-                assignid=assign_id, groupid=0, filter="")
-            user_map = {p["id"]: p for p in participants}
-        except Exception:
-            user_map = {}
-
-        submissions = []
-        for assign in sub_data.get("assignments", []):
-            for sub in assign.get("submissions", []):
-                uid = sub["userid"]
-                if group_member_ids and uid not in group_member_ids:
-                    continue
-                user = user_map.get(uid, {})
-                files = []
-                for plugin in sub.get("plugins", []):
-                    if plugin.get("type") == "file":
-                        for area in plugin.get("fileareas", []):
-                            for f in area.get("files", []):
-                                files.append(MoodleFile(
-                                    filename=f["filename"],
-                                    fileurl=f["fileurl"],
-                                    filesize=f.get("filesize", 0)))
-                if sub.get("status") == "submitted" and files:
-                    submissions.append(MoodleSubmission(
-                        user_id=uid,
-                        full_name=user.get("fullname", f"User {uid}"),
-                        email=user.get("email", ""),
-                        status=sub["status"],
-                        grading_status=user.get("gradingstatus", "notgraded"),
-                        time_modified=sub.get("timemodified", 0),
-                        files=files))
-        return submissions
+    s = await _get_session()
+    sub_data, participants = await batch_call(s, [
+        ("mod_assign_get_submissions", {"assignmentids": [assign_id]}),
+        ("mod_assign_list_participants",
+         {"assignid": assign_id, "groupid": 0, "filter": ""}),
+    ])
+    if isinstance(sub_data, Exception):
+        raise sub_data
+    if isinstance(participants, Exception):
+        user_map = {}
+    else:
+        _participants_cache[assign_id] = (time.monotonic(), participants)
+        user_map = {p["id"]: p for p in participants}
+
+    submissions = []
+    for assign in sub_data.get("assignments", []):
+        for sub in assign.get("submissions", []):
+            uid = sub["userid"]
+            if group_member_ids and uid not in group_member_ids:
+                continue
+            user = user_map.get(uid, {})
+            files = []
+            for plugin in sub.get("plugins", []):
+                if plugin.get("type") == "file":
+                    for area in plugin.get("fileareas", []):
+                        for f in area.get("files", []):
+                            files.append(MoodleFile(
+                                filename=f["filename"],
+                                fileurl=f["fileurl"],
+                                filesize=f.get("filesize", 0)))
+            if sub.get("status") == "submitted" and files:
+                submissions.append(MoodleSubmission(
+                    user_id=uid,
+                    full_name=user.get("fullname", f"User {uid}"),
+                    email=user.get("email", ""),
+                    status=sub["status"],
+                    grading_status=user.get("gradingstatus", "notgraded"),
+                    time_modified=sub.get("timemodified", 0),
+                    files=files,
+                    archive_file=next(
+                        (f for f in files if _ARCHIVE_RE.search(f.filename)),
+                        None)))
+    return submissions
 
 
 async def get_ungraded(assign_id, group_member_ids=None):
@@ -187,29 +332,47 @@ async def get_ungraded(assign_id, group_member_ids=None):
 
 async def download_file(file, dest_path):
     url = f"{file.fileurl}?token={MOODLE_TOKEN}"
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url) as resp:
-            if resp.status != 200:
-                raise Exception(f"Download failed: HTTP {resp.status}")
-            with open(dest_path, 'wb') as f:
-                async for chunk in resp.content.iter_chunked(8192):
-                    f.write(chunk)
+    s = await _get_session()
+    async with s.get(url, timeout=_DOWNLOAD_TIMEOUT) as resp:
+        if resp.status != 200:
+            raise Exception(f"Download failed: HTTP {resp.status}")
+        with open(dest_path, 'wb', buffering=1 << 20) as f:
+            async for chunk in resp.content.iter_chunked(1 << 20):
+                f.write(chunk)
+
+
+async def download_bytes(file):
+    """Download a submission file into memory."""
+    url = f"{file.fileurl}?token={MOODLE_TOKEN}"
+    s = await _get_session()
+    async with s.get(url, timeout=_DOWNLOAD_TIMEOUT) as resp:
+        if resp.status != 200:
+            raise Exception(f"Download failed: HTTP {resp.status}")
+        return await resp.read()
 
 
 async def submit_grade(assign_id, user_id, grade, feedback_html):
-    async with aiohttp.ClientSession() as s:
-        params = {
-            "wstoken": MOODLE_TOKEN,
-            "wsfunction": "mod_assign_save_grade",
-            "moodlewsrestformat": "json",
-            "assignmentid": assign_id, "userid": user_id,
-            "grade": grade, "attemptnumber": -1,
-            "addattempt": 0, "workflowstate": "", "applytoall": 1,
-            "plugindata[assignfeedbackcomments_editor][text]": feedback_html,
-            "plugindata[assignfeedbackcomments_editor][format]": 1,
-        }
-        async with s.post(API, data=params) as resp:
-            text = await resp.text()
-            if "exception" in text.lower():
-                raise Exception(f"Grade submit failed: {text[:300]}")
-            log.info(f"Grade submitted: user={user_id} grade={grade}")
\ No newline at end of file
+    s = await _get_session()
+    params = {
+        "wstoken": MOODLE_TOKEN,
+        "wsfunction": "mod_assign_save_grade",
+        "moodlewsrestformat": "json",
+        "assignmentid": assign_id, "userid": user_id,
+        "grade": grade, "attemptnumber": -1,
+        "addattempt": 0, "workflowstate": "", "applytoall": 1,
+        "plugindata[assignfeedbackcomments_editor][text]": feedback_html,
+        "plugindata[assignfeedbackcomments_editor][format]": 1,
+    }
+    async with s.post(API, data=params) as resp:
+        # Success is a JSON null; errors come back as an exception object.
+        text = await resp.text()
+        try:
+            data = json.loads(text)
+        except ValueError:
+            # An HTML error page from Moodle or a proxy in front of it.
+            raise Exception(
+                f"Grade submit failed: HTTP {resp.status}: {text[:200]}")
+        if isinstance(data, dict) and "exception" in data:
+            msg = data.get("message", data.get("errorcode", "Unknown"))
+            raise Exception(f"Grade submit failed: {msg}")
+        log.info(f"Grade submitted: user={user_id} grade={grade}")
\ No newline at end of file